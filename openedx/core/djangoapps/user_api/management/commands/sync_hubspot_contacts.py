@@ -6,22 +6,81 @@ Management command to sync platform users with hubspot
 
 
 import json
+import threading
 import time
 import traceback
 import urllib.parse  # pylint: disable=import-error
-from datetime import datetime, timedelta
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import timedelta
 from textwrap import dedent
 
 import requests
 from django.contrib.auth.models import User  # lint-amnesty, pylint: disable=imported-auth-user
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
 
-from common.djangoapps.student.models import UserAttribute
+from common.djangoapps.student.models import UserProfile
 from common.djangoapps.util.query import use_read_replica_if_available
 from openedx.core.djangoapps.site_configuration.models import SiteConfiguration
 
 HUBSPOT_API_BASE_URL = 'https://api.hubapi.com'
+HUBSPOT_CONTACTS_BATCH_URL = urllib.parse.urljoin(f"{HUBSPOT_API_BASE_URL}/", 'contacts/v1/contact/batch/')
+# number of contact batches which may be in flight to hubspot at the same time
+HUBSPOT_MAX_CONCURRENT_REQUESTS = 10
+HUBSPOT_MAX_REQUESTS_PER_SECOND = 10
+# number of submitted contact batches above which the next users slice is not fetched until some batches finish
+HUBSPOT_MAX_PENDING_BATCHES = 2 * HUBSPOT_MAX_CONCURRENT_REQUESTS
+# number of users fetched from the database at a time
+USERS_QUERY_BATCH_SIZE = 5000
+
+# choice displays are looked up directly, instead of get_<field>_display() building the choices dict on every call
+GENDER_DISPLAY = dict(UserProfile.GENDER_CHOICES)
+LEVEL_OF_EDUCATION_DISPLAY = dict(UserProfile.LEVEL_OF_EDUCATION_CHOICES)
+
+# hubspot contact properties, along with the getter of their value from a user and its profile meta
+HUBSPOT_CONTACT_PROPERTIES = (
+    ('firstname', lambda user, meta: meta.get('first_name', '')),
+    ('lastname', lambda user, meta: meta.get('last_name', '')),
+    ('company', lambda user, meta: meta.get('company', '')),
+    ('jobtitle', lambda user, meta: meta.get('title', '')),
+    ('state', lambda user, meta: meta.get('state', '')),
+    ('country', lambda user, meta: meta.get('country', '')),
+    ('gender', lambda user, meta: GENDER_DISPLAY.get(user.profile.gender, user.profile.gender)),
+    ('degree', lambda user, meta: LEVEL_OF_EDUCATION_DISPLAY.get(
+        user.profile.level_of_education, user.profile.level_of_education
+    )),
+)
+
+
+class RateLimiter:
+    """
+    Blocks callers so that at most `max_calls` calls are made within any `period` seconds.
+    """
+
+    def __init__(self, max_calls, period):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Wait until one more call can be made without exceeding the rate limit, and record it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if len(self._calls) >= self.max_calls:
+                delay = self.period - (now - self._calls[0])
+                if delay > 0:
+                    time.sleep(delay)
+                    now = time.monotonic()
+                self._calls.popleft()
+            self._calls.append(now)
 
 
 class Command(BaseCommand):
@@ -42,46 +101,80 @@ class Command(BaseCommand):
         ]
         return hubspot_sites
 
+    def _get_http_session(self):
+        """
+        Returns: requests session which keeps connections to hubspot alive across batches
+        """
+        retry = Retry(
+            total=5,
+            backoff_factor=0.2,
+            # these retries happen inside session.post and are not counted by the RateLimiter. 429 is not retried,
+            # as it means the rate limit was hit. 502/503 retries do bypass the limiter, but they only follow
+            # server errors and are spaced out by the backoff.
+            status_forcelist=[502, 503],
+            allowed_methods=None,  # contacts are upserted by email, so retrying a POST is safe
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=HUBSPOT_MAX_CONCURRENT_REQUESTS,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        return session
+
     def _get_users_queryset(self, initial_days):
         """
         initial_days: numbers of days to go back from today
         :return: users queryset
         """
-        start_date = datetime.now().date() - timedelta(initial_days)
-        end_date = datetime.now().date() - timedelta(1)
+        today = timezone.now().date()
+        start_date = today - timedelta(initial_days)
+        end_date = today - timedelta(1)
         self.stdout.write(f'Getting users from {start_date} to {end_date}')
         users_qs = User.objects.filter(
             date_joined__date__gte=start_date,
             date_joined__date__lte=end_date
+        ).select_related('profile').only(
+            # only load the columns which are sent to hubspot
+            'username',
+            'email',
+            'profile__user',
+            'profile__meta',
+            'profile__gender',
+            'profile__level_of_education',
         ).order_by('id')
         return use_read_replica_if_available(users_qs)
 
-    def _get_batched_users(self, site_domain, users_queryset, offset, users_query_batch_size):
+    def _get_users_by_site(self, users_queryset, site_domains):
         """
         Args:
-            site_domain: site where we need unsynced users
-            users_queryset: users_queryset to slice
-            users_query_batch_size: slice size
+            users_queryset: users_queryset to fetch
+            site_domains: domains of the sites to sync
 
-        Returns: site users
+        Yields: for each users slice, dict of site domain to the users of the slice created on that site
 
         """
+        users_queryset = users_queryset.filter(
+            attributes__name='created_on_site',
+            attributes__value__in=site_domains,
+        ).annotate(created_on_site=F('attributes__value'))
+        last_id = 0
 
-        self.stdout.write(
-            'Fetching Users for site {site} from {start} to {end}'.format(
-                site=site_domain, start=offset, end=offset + users_query_batch_size
-            )
-        )
-        users = users_queryset.select_related('profile')[offset: offset + users_query_batch_size]
-        site_users = [
-            user for user in users
-            if UserAttribute.get_user_attribute(user, 'created_on_site') == site_domain
-        ]
-        self.stdout.write(f'\tSite Users={len(site_users)}')
+        while True:
+            self.stdout.write(f'Fetching Users after id {last_id}')
+            # filter on id instead of using an offset, so the database does not scan the previous slices again
+            users = list(users_queryset.filter(id__gt=last_id)[:USERS_QUERY_BATCH_SIZE])
+            users_by_site = defaultdict(list)
+            for user in users:
+                users_by_site[user.created_on_site].append(user)
+            yield users_by_site
+            if len(users) < USERS_QUERY_BATCH_SIZE:
+                break
+            last_id = users[-1].id
 
-        return site_users
-
-    def _sync_with_hubspot(self, users_batch, site_conf):
+    def _sync_with_hubspot(self, session, users_batch, api_key, site_domain, rate_limiter):
         """
         Sync batch of users with hubspot
         """
@@ -102,93 +195,93 @@ class Command(BaseCommand):
             contact = {
                 "email": user.email,
                 "properties": [
-                    {
-                        "property": "firstname",
-                        "value": meta.get('first_name', '')
-                    },
-                    {
-                        "property": "lastname",
-                        "value": meta.get('last_name', '')
-                    },
-                    {
-                        "property": "company",
-                        "value": meta.get('company', '')
-                    },
-                    {
-                        "property": "jobtitle",
-                        "value": meta.get('title', '')
-                    },
-                    {
-                        "property": "state",
-                        "value": meta.get('state', '')
-                    },
-                    {
-                        "property": "country",
-                        "value": meta.get('country', '')
-                    },
-                    {
-                        "property": "gender",
-                        "value": user.profile.get_gender_display()
-                    },
-                    {
-                        "property": "degree",
-                        "value": user.profile.get_level_of_education_display()
-                    },
+                    {"property": name, "value": getter(user, meta)} for name, getter in HUBSPOT_CONTACT_PROPERTIES
                 ]
             }
             contacts.append(contact)
 
-        api_key = site_conf.get_value('HUBSPOT_API_KEY')
-        api_url = urllib.parse.urljoin(f"{HUBSPOT_API_BASE_URL}/", 'contacts/v1/contact/batch/')
         try:
-            response = requests.post(api_url, json=contacts, params={"hapikey": api_key})
+            rate_limiter.wait()
+            response = session.post(HUBSPOT_CONTACTS_BATCH_URL, json=contacts, params={"hapikey": api_key})
             response.raise_for_status()
             return len(contacts)
         except HTTPError as ex:
             message = 'An error occurred while syncing batch of contacts for site {domain}, {message}'.format(
-                domain=site_conf.site.domain, message=str(ex)
+                domain=site_domain, message=str(ex)
             )
             self.stderr.write(message)
             return 0
 
-    def _sync_site(self, site_conf, users_queryset, users_count, contacts_batch_size):
-        """
-            Syncs a single site
+    def _sync_site(self, executor, session, site_domain, api_key, users_queue, contacts_batch_size, rate_limiter,
+                   flush=False):
         """
-        site_domain = site_conf.site.domain
-        self.stdout.write(f'Syncing process started for site {site_domain}')
-
-        offset = 0
-        users_queue = []
-        users_query_batch_size = 5000
-        successfully_synced_contacts = 0
+            Submits batches of the queued users of a single site to hubspot.
+            Users not filling a whole batch are left in the queue for the next users slice, unless flushing.
 
-        while offset < users_count:
-            is_last_iteration = (offset + users_query_batch_size) >= users_count
+            Returns: futures of the submitted batches
+        """
+        sync_results = []
+        while len(users_queue) >= contacts_batch_size or (flush and users_queue):
+            users_batch = [users_queue.popleft() for _ in range(min(contacts_batch_size, len(users_queue)))]
             self.stdout.write(
-                'Syncing users batch from {start} to {end} for site {site}'.format(
-                    start=offset, end=offset + users_query_batch_size, site=site_domain
+                'Syncing users batch from id {start} to {end} for site {site}'.format(
+                    start=users_batch[0].id, end=users_batch[-1].id, site=site_domain
                 )
             )
-            users_queue += self._get_batched_users(site_domain, users_queryset, offset, users_query_batch_size)
-            while len(users_queue) >= contacts_batch_size \
-                    or (is_last_iteration and users_queue):  # for last iteration need to empty users_queue
-                users_batch = users_queue[:contacts_batch_size]
-                del users_queue[:contacts_batch_size]
-                successfully_synced_contacts += self._sync_with_hubspot(users_batch, site_conf)
-                time.sleep(0.1)  # to make sure request per second could not exceed by 10
-            self.stdout.write(
-                'Successfully synced users batch from {start} to {end} for site {site}'.format(
-                    start=offset, end=offset + users_query_batch_size, site=site_domain
-                )
+            sync_results.append(
+                executor.submit(self._sync_with_hubspot, session, users_batch, api_key, site_domain, rate_limiter)
             )
-            offset += users_query_batch_size
+        return sync_results
 
-        self.stdout.write(
-            '{count} contacts found and sycned for site {site}'.format(
-                count=successfully_synced_contacts, site=site_domain
-            )
-        )
+    def _sync_sites(self, session, hubspot_sites, users_queryset, contacts_batch_size):
+        """
+            Syncs all hubspot enabled sites, fetching their users once
+
+            Returns: dict of site domain to the number of successfully synced contacts
+        """
+        api_keys = {site_conf.site.domain: site_conf.get_value('HUBSPOT_API_KEY') for site_conf in hubspot_sites}
+        # sites are synced from the same pool, so a single limiter keeps the whole process within the rate limit
+        rate_limiter = RateLimiter(HUBSPOT_MAX_REQUESTS_PER_SECOND, 1)
+        users_queues = {site_domain: deque() for site_domain in api_keys}
+        successfully_synced_contacts = dict.fromkeys(api_keys, 0)
+        pending_results = {}  # future of a submitted batch -> its site domain
+
+        for site_domain in api_keys:
+            self.stdout.write(f'Syncing process started for site {site_domain}')
+
+        # hubspot requests are sent from a pool so that slow responses overlap with each other
+        # and with fetching the next users slice from the database
+        with ThreadPoolExecutor(max_workers=HUBSPOT_MAX_CONCURRENT_REQUESTS) as executor:
+            try:
+                for users_by_site in self._get_users_by_site(users_queryset, list(api_keys)):
+                    for site_domain, site_users in users_by_site.items():
+                        self.stdout.write(f'\tSite Users={len(site_users)} for site {site_domain}')
+                        users_queues[site_domain].extend(site_users)
+                        for sync_result in self._sync_site(
+                            executor, session, site_domain, api_keys[site_domain], users_queues[site_domain],
+                            contacts_batch_size, rate_limiter,
+                        ):
+                            pending_results[sync_result] = site_domain
+                    # let hubspot catch up before fetching the next slice, so fetched users do not pile up in memory
+                    while len(pending_results) > HUBSPOT_MAX_PENDING_BATCHES:
+                        done_results, _ = wait(pending_results, return_when=FIRST_COMPLETED)
+                        for sync_result in done_results:
+                            successfully_synced_contacts[pending_results.pop(sync_result)] += sync_result.result()
+
+                for site_domain, users_queue in users_queues.items():
+                    for sync_result in self._sync_site(
+                        executor, session, site_domain, api_keys[site_domain], users_queue,
+                        contacts_batch_size, rate_limiter, flush=True,
+                    ):
+                        pending_results[sync_result] = site_domain
+                for sync_result in as_completed(list(pending_results)):
+                    successfully_synced_contacts[pending_results.pop(sync_result)] += sync_result.result()
+            except Exception:
+                # stop sending the remaining batches, as a serial sync would have stopped at the first failure
+                executor.shutdown(cancel_futures=True)
+                raise
+
+        return successfully_synced_contacts
 
     def add_arguments(self, parser):
         """
@@ -220,10 +313,13 @@ class Command(BaseCommand):
             hubspot_sites = self._get_hubspot_enabled_sites()
             self.stdout.write(f'{len(hubspot_sites)} hubspot enabled sites found.')
             users_queryset = self._get_users_queryset(initial_sync_days)
-            users_count = users_queryset.count()
-            self.stdout.write(f'Users count={users_count}')
-            for site_conf in hubspot_sites:
-                self._sync_site(site_conf, users_queryset, users_count, batch_size)
+            with self._get_http_session() as session:
+                successfully_synced_contacts = self._sync_sites(session, hubspot_sites, users_queryset, batch_size)
+            for site_domain, synced_contacts in successfully_synced_contacts.items():
+                self.stdout.write(f'Successfully synced users batches for site {site_domain}')
+                self.stdout.write(
+                    '{count} contacts found and sycned for site {site}'.format(count=synced_contacts, site=site_domain)
+                )
 
         except Exception as ex:
             traceback.print_exc()
@@ -6,14 +6,18 @@ Test the sync_hubspot_contacts management command
 import json
 from datetime import timedelta
 from io import StringIO
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
+import pytest
+import requests
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 from django.utils import timezone
 
 from openedx.core.djangoapps.site_configuration.tests.factories import SiteConfigurationFactory
 from openedx.core.djangoapps.user_api.management.commands.sync_hubspot_contacts import Command as sync_command
+from openedx.core.djangoapps.user_api.management.commands.sync_hubspot_contacts import RateLimiter
 from openedx.core.djangolib.testing.utils import skip_unless_lms
 from common.djangoapps.student.models import UserAttribute, UserProfile
 from common.djangoapps.student.tests.factories import UserFactory
@@ -100,3 +104,121 @@ class TestHubspotSyncCommand(TestCase):
         assert 'Successfully synced users' in output
         assert mock_sync_with_hubspot.call_count == 1
         sync_with_hubspot.stop()
+
+    def test_synced_contacts_count(self):
+        """
+        Test synced contacts of a site are counted from the batches sent to hubspot
+        """
+        out = StringIO()
+        with patch.object(
+            sync_command, '_sync_with_hubspot', side_effect=lambda session, users_batch, *args: len(users_batch)
+        ):
+            call_command('sync_hubspot_contacts', '--initial-sync-days=7', '--batch-size=2', stdout=out)
+        output = out.getvalue()
+        site_domain = self.hubspot_site_config.site.domain
+        assert f'Successfully synced users batches for site {site_domain}' in output
+        assert f'7 contacts found and sycned for site {site_domain}' in output
+
+    def test_sync_stops_on_unexpected_error(self):
+        """
+        Test the command fails without reporting success if a batch raises something other than an HTTPError
+        """
+        out = StringIO()
+        with patch.object(
+            sync_command, '_sync_with_hubspot', side_effect=[2, requests.ConnectionError('connection refused'), 2, 1]
+        ):
+            with pytest.raises(CommandError):
+                call_command('sync_hubspot_contacts', '--initial-sync-days=7', '--batch-size=2', stdout=out)
+        assert 'Successfully synced users' not in out.getvalue()
+        assert 'contacts found and sycned' not in out.getvalue()
+
+    def test_get_users_by_site(self):
+        """
+        Test a users slice is fetched once and grouped by the site users were created on
+        """
+        command = sync_command(stdout=StringIO())
+        users_queryset = command._get_users_queryset(7)  # pylint: disable=protected-access
+        site_domains = [self.hubspot_site_config.site.domain, self.site_config.site.domain]
+        with self.assertNumQueries(1):
+            users_by_site = next(
+                command._get_users_by_site(users_queryset, site_domains)  # pylint: disable=protected-access
+            )
+        for site_domain in site_domains:
+            assert len(users_by_site[site_domain]) == 7
+            for user in users_by_site[site_domain]:
+                assert user.created_on_site == site_domain
+
+    def test_get_users_by_site_in_several_slices(self):
+        """
+        Test users are fetched slice by slice without missing or repeating any, including when the last slice is full
+        """
+        command = sync_command(stdout=StringIO())
+        users_queryset = command._get_users_queryset(7)  # pylint: disable=protected-access
+        site_domains = [self.hubspot_site_config.site.domain, self.site_config.site.domain]
+        expected_user_ids = sorted(user.id for user in self.users[0:7] + self.users[19:26])
+        # 14 users: 7 full slices and a final empty one, then 4 full slices and a final short one
+        for users_query_batch_size, slices_count in ((2, 8), (3, 5)):
+            with self.subTest(users_query_batch_size=users_query_batch_size), patch(
+                'openedx.core.djangoapps.user_api.management.commands.sync_hubspot_contacts.USERS_QUERY_BATCH_SIZE',
+                users_query_batch_size,
+            ):
+                with self.assertNumQueries(slices_count):
+                    slices = list(
+                        command._get_users_by_site(users_queryset, site_domains)  # pylint: disable=protected-access
+                    )
+                user_ids = [
+                    user.id for users_by_site in slices for site_users in users_by_site.values() for user in site_users
+                ]
+                assert len(slices) == slices_count
+                assert sorted(user_ids) == expected_user_ids
+
+    def test_sync_with_hubspot_contacts_payload(self):
+        """
+        Test contact properties sent to hubspot for a batch of users, built without loading any deferred field
+        """
+        command = sync_command(stdout=StringIO())
+        site_domain = self.hubspot_site_config.site.domain
+        users_queryset = command._get_users_queryset(7)  # pylint: disable=protected-access
+        users_by_site = next(
+            command._get_users_by_site(users_queryset, [site_domain])  # pylint: disable=protected-access
+        )
+        site_users = users_by_site[site_domain]
+        session = Mock()
+        with self.assertNumQueries(0):
+            synced_contacts = command._sync_with_hubspot(  # pylint: disable=protected-access
+                session, site_users, 'test_key', site_domain, Mock()
+            )
+        assert synced_contacts == 7
+        contacts = session.post.call_args[1]['json']
+        assert contacts[0] == {
+            'email': site_users[0].email,
+            'properties': [
+                {'property': 'firstname', 'value': 'First Name1'},
+                {'property': 'lastname', 'value': 'Last Name1'},
+                {'property': 'company', 'value': 'Company1'},
+                {'property': 'jobtitle', 'value': 'Title1'},
+                {'property': 'state', 'value': 'State1'},
+                {'property': 'country', 'value': 'US'},
+                {'property': 'gender', 'value': 'Male'},
+                {'property': 'degree', 'value': 'Doctorate'},
+            ]
+        }
+
+
+class TestRateLimiter(TestCase):
+    """
+    Test the RateLimiter used to throttle hubspot requests.
+    """
+
+    @patch('openedx.core.djangoapps.user_api.management.commands.sync_hubspot_contacts.time')
+    def test_wait_once_limit_is_reached(self, mock_time):
+        """
+        Test calls within the limit are not delayed and the next call waits for the oldest one to expire
+        """
+        mock_time.monotonic.side_effect = [0.0, 0.2, 0.6, 1.0]
+        rate_limiter = RateLimiter(max_calls=2, period=1)
+        rate_limiter.wait()
+        rate_limiter.wait()
+        assert not mock_time.sleep.called
+        rate_limiter.wait()
+        mock_time.sleep.assert_called_once_with(0.4)